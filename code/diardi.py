@@ -2,16 +2,32 @@
 """Sends spectral and A-weighted sound readings to influxdb"""
 
 import argparse
-import datetime
+from functools import partial
 import logging
+import math
 import platform
+import queue
+import threading
 import time
 
 from influxdb import InfluxDBClient
+from numba import njit
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import scipy.fft
+import scipy.signal
 import sounddevice as sd
 
-VERSION = '0.0.2'
+# Use Intel's MKL FFT if it's installed, falling back to scipy's
+try:
+    from mkl_fft.interfaces.numpy_fft import rfft
+except ImportError:
+    try:
+        from mkl_fft._numpy_fft import rfft  # Older mkl_fft releases
+    except ImportError:
+        rfft = partial(scipy.fft.rfft, workers=-1)
+
+VERSION = '0.0.3'
 DEFAULT_BUCKET = f"soundlevel_v{VERSION}"
 
 TAGS = {"version": VERSION, "sensorId": 0}
@@ -48,6 +64,11 @@ parser.add_argument("-t", "--time", type=float, metavar="SECONDS",
                     default=30,
                     help="Time between sample transmissions (default: %(default)s seconds)")
 
+parser.add_argument("--ema-alpha", type=float, metavar="ALPHA",
+                    default=0.5,
+                    help="Weight of the newest reading in the per-bin moving average, "
+                    "1 to disable smoothing (default: %(default)s)")
+
 parser.add_argument("--server", default="127.0.0.1", metavar="HOSTNAME",
                     help="Influxdb hostname string to use (default: %(default)s)")
 
@@ -71,6 +92,9 @@ if args.list_devices:
     print(sd.query_devices())
     parser.exit(0)
 
+if not 0 < args.ema_alpha <= 1:
+    parser.error('--ema-alpha must be in (0, 1]')
+
 ############################################################
 # Actual program
 
@@ -78,151 +102,388 @@ samplerate = 48000
 
 fftsize = 2048
 
+# The ring and FFT scratch buffers are sized from this, so blocks
+# need a fixed size of at least one FFT frame
+if args.blocksize < fftsize:
+    parser.error(f'--blocksize must be at least {fftsize} samples')
+
+N_BINS = fftsize//2  # Power bins we keep from each FFT: everything but nyquist
+
+FFT_HOP = fftsize//2  # Frames overlap by 50%
+
+# Hann window for the FFT frames, scaled so that a windowed frame
+# carries the same power as an unwindowed one
+FFT_WINDOW = scipy.signal.get_window('hann', fftsize).astype(np.float32)
+FFT_WINDOW *= np.sqrt(fftsize/np.sum(FFT_WINDOW**2))
+
+# The frequency ranges we report on, by their upper cutoffs in Hz, and
+# the FFT bins that go into each one
+SPLITS = np.array([ 100, 500, 1000, 2500, 5000, 10000, ])
+SPLITS = SPLITS[SPLITS <= samplerate//2]
+HZ_PER_BIN = samplerate/fftsize
+BAND_EDGES = np.concatenate(([1],  # skip DC
+                             np.minimum(SPLITS//HZ_PER_BIN, N_BINS))).astype(int)
+BAND_LABELS = [f"f{f0}-{f1}" for f0, f1 in zip([0, *SPLITS[:-1]], SPLITS)]
+
+
+def a_weighting_sos(fs):
+    '''Build an A-weighting filter for sample rate fs, as second-order sections
+
+    This takes the analog A-weighting prototype from IEC 61672 through
+    the bilinear transform, then normalizes it to 0dB at 1kHz.
+    '''
+    f1, f2, f3, f4 = 20.598997, 107.65265, 737.86223, 12194.217
+    poles = -2*np.pi*np.array([f1, f1, f2, f3, f4, f4])
+
+    z, p, k = scipy.signal.bilinear_zpk([0, 0, 0, 0], poles, 1, fs)
+    sos = scipy.signal.zpk2sos(z, p, k)
+
+    _, h = scipy.signal.sosfreqz(sos, worN=[1000], fs=fs)
+    sos[0, :3] /= np.abs(h[0])
+
+    return sos
+
+
+a_weight_sos = a_weighting_sos(samplerate)
+
+
+@njit(cache=True, fastmath=True)
+def aggregate(bins, edges):
+    '''Get the RMS of the mean bin powers between each pair of edges
+
+    This is one fused pass over the accumulator, rather than a numpy
+    call per frequency range.
+    '''
+    out = np.empty(len(edges)-1, dtype=np.float64)
+    for i in range(len(edges)-1):
+        s = 0.0
+        for j in range(edges[i], edges[i+1]):
+            s += bins[j]
+        out[i] = math.sqrt(s / (edges[i+1]-edges[i]))
+    return out
+
+
+# Compilation holds the GIL, so get it done before the stream and
+# threads start up
+aggregate(np.zeros(N_BINS, dtype=np.float32), BAND_EDGES)
+
+
 TAGS["nodename"] = args.nodename
 
-client = InfluxDBClient(host=args.server)
+client = InfluxDBClient(host=args.server, gzip=True)
 client.create_database(args.database)
 client.switch_database(args.database)
 
 client.write_points([{
             "measurement": "startup",
             "fields": { "i": 1, },
-            "time": datetime.datetime.utcnow().isoformat(),
-            }])
+            "time": time.time_ns(),
+            }], time_precision='n')
 
 
 ####################
-# Global shared: note that this confines us to single-threading without a mutex
-bin_accumulator = np.zeros(fftsize)  # Accumulate squares of bins
+# Global shared between the FFT worker and the main loop, guarded by accum_lock
+accum_lock = threading.Lock()
+bin_accumulator = np.zeros(N_BINS, dtype=np.float32)  # Accumulate squares of bins
 n_samples = 0  # Count of FFT samples we've taken
+a_weight_sum = 0.0  # Accumulate squares of A-weighted samples
+a_weight_n = 0  # Count of A-weighted samples
+
+####################
+# Owned by the FFT worker thread
+
+# Float samples for the FFT frames.  The tail of each block that
+# didn't start a frame yet is carried over to the front of this, so
+# that frames overlap across block boundaries too.
+fft_buf = np.empty(args.blocksize + fftsize, dtype=np.float32)
+fft_carry = 0  # Samples at the start of fft_buf left from the last block
+
+# Scratch space for windowed FFT frames and their squared magnitudes,
+# one row per frame in a block
+max_frames = args.blocksize//FFT_HOP + 1
+fft_windowed = np.empty((max_frames, fftsize), dtype=np.float32)
+fft_mags = np.empty((max_frames, N_BINS), dtype=np.float32)
+fft_mags_imag = np.empty_like(fft_mags)
+
+a_weight_zi = np.zeros((a_weight_sos.shape[0], 2))  # A-weighting filter state
+
+####################
+# A ring of raw sample blocks handed from the callback to the FFT
+# worker.  Only the callback advances ring_head, and only the worker
+# advances ring_tail, so neither needs a lock.
+RING_SLOTS = 16
+ring = np.empty((RING_SLOTS, args.blocksize), dtype=np.int16)
+ring_len = np.zeros(RING_SLOTS, dtype=int)  # Samples in each slot
+ring_status = [None] * RING_SLOTS  # Callback status flags that came with each slot
+ring_head = 0
+ring_tail = 0
+ring_event = threading.Event()  # Set by the callback when it fills a slot
+n_overruns = 0  # Count of blocks dropped because the ring was full
+ring_gap = np.zeros(RING_SLOTS, dtype=bool)  # Were blocks dropped before the slot?
+gap_pending = False  # Have we dropped blocks since filling the last slot?
+status_pending = None  # Latest status from a dropped block, for the next slot
+
+# A queue of readings to kick over to the server.  Everything goes
+# through here, so that all influx work happens in the sender thread.
+send_q = queue.Queue(maxsize=1024)
+n_dropped = 0  # Count of readings we had no room to queue
+
+# Failed writes get retried, but after MAX_SEND_FAILURES in a row the
+# sender gives up and sets send_failed, so the main loop can exit and
+# let systemd restart us (which also recreates the database).
+MAX_SEND_FAILURES = 5
+SEND_RETRY_SECONDS = 5
+n_send_failures = 0  # Count of failed writes
+send_failed = threading.Event()
+
+
+def enqueue(point):
+    '''Queue up a reading for the sender thread, without ever blocking'''
+    global n_dropped
+
+    try:
+        send_q.put_nowait(point)
+    except queue.Full:
+        n_dropped += 1
+
+
+def sender_loop():
+    '''Sender thread: batch up whatever's queued and write it to influx'''
+    global n_send_failures
 
-# A queue of readings to kick over to the server, used to queue up
-# status messages for OOB sending.
-frame_queue = []
+    batch = []  # Carries over across retries
+    failures = 0  # Failed writes in a row
 
-def callback(indata, frames, time, status):
+    while True:
+        if not batch:
+            batch.append(send_q.get())
+        while True:
+            try:
+                batch.append(send_q.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            client.write_points(batch, time_precision='n', batch_size=5000)
+            logging.debug(f'Sent datapoints: {batch}')
+            failures = 0
+        except Exception as e:
+            n_send_failures += 1
+            failures += 1
+            logging.error(f'Failed to send {len(batch)} datapoints ({failures} in a row): {e}')
+
+            if failures < MAX_SEND_FAILURES:
+                time.sleep(SEND_RETRY_SECONDS)
+                continue
+
+            logging.error(f'Giving up on {len(batch)} datapoints')
+            send_failed.set()
+
+        for _ in batch:
+            send_q.task_done()
+        batch = []
+
+
+def callback(indata, frames, time_info, status):
     '''Callback for sounddevice after it's accumulated our frames
 
-    This just accumulates state into the above globals, with all
-    influx work happening in the main loop below.
+    This runs on PortAudio's realtime thread, so it just copies the
+    block into the ring for the FFT worker, with all the numeric work
+    happening there and all influx work in the sender thread.
     '''
-    global bin_accumulator, n_samples, frame_queue
-
-    ts = datetime.datetime.utcnow().isoformat()
+    global ring_head, n_overruns, gap_pending, status_pending
 
     #    logging.debug(f'Got samples {len(indata)}')
-    got_status = False
+
+    if status:
+        status_pending = status  # The worker reports these
+
+    if ring_head - ring_tail >= RING_SLOTS:
+        n_overruns += 1  # The main loop reports these
+        gap_pending = True
+        return
+
+    # We get raw single-channel int16 samples from the stream
+    mono = np.frombuffer(indata, dtype=np.int16)
+
+    slot = ring_head % RING_SLOTS
+    np.copyto(ring[slot, :len(mono)], mono)
+    ring_len[slot] = len(mono)
+    ring_status[slot] = status_pending
+    status_pending = None
+    ring_gap[slot] = gap_pending
+    gap_pending = False
+
+    ring_head += 1
+    ring_event.set()
+
+
+def process_block(mono, status):
+    '''Run the A-weighting and FFTs on one block of samples
+
+    The results get accumulated into the shared globals above, and any
+    status the callback got with the block gets reported.
+    '''
+    global bin_accumulator, n_samples, a_weight_sum, a_weight_n
+    global a_weight_zi, fft_carry
 
     if status:
         logging.error(f'Got error status: {status}')
         errtags = TAGS.copy()
         errtags["error"] = "got_status"
 
-        frame_queue.append({
+        enqueue({
             "measurement": args.measurement_name + "_error",
             "fields": { "status_text": str(status), },
             "tags": errtags,
-            "time": ts,
+            "time": time.time_ns(),
             })
 
-        got_status = True
-
-    if any(indata):
-        n0 = 0
-
-        while n0 < indata.shape[0]-fftsize:
-            mags = np.abs(np.fft.rfft(indata[n0:n0+2*fftsize, 0]))
-            mags *= mags
-
-            bin_accumulator += mags[:-1]  # drop the nyquist bin
-            n_samples += 1
-            n0 += fftsize
+    if mono.any():
+        # Scale to [-1, 1) floats, as sounddevice would have done for us,
+        # after whatever we carried over from the last block
+        total = fft_carry + len(mono)
+        samples = fft_buf[fft_carry:total]
+        np.multiply(mono, np.float32(1.0/32768.0), out=samples)
+
+        a_weighted, a_weight_zi = scipy.signal.sosfilt(a_weight_sos, samples,
+                                                       zi=a_weight_zi)
+        a_weighted_sum = np.dot(a_weighted, a_weighted)
+
+        # Overlapping frames as a zero-copy strided view of the samples
+        fft_frames = sliding_window_view(fft_buf[:total], fftsize)[::FFT_HOP]
+        nframes = len(fft_frames)
+
+        windowed = fft_windowed[:nframes]
+        np.multiply(fft_frames, FFT_WINDOW, out=windowed)
+
+        # Carry everything from where the next frame starts over to the
+        # next block
+        next_start = nframes*FFT_HOP
+        fft_carry = total - next_start
+        fft_buf[:fft_carry] = fft_buf[next_start:total]
+
+        # Transform every frame in the block in one batched call, keeping
+        # everything in single precision: complex64 out of the FFT
+        spec = rfft(windowed, axis=1)
+
+        # Squared magnitudes straight from the real and imaginary
+        # parts, for only the bins we keep
+        spec = spec[:, :N_BINS]
+        mags2 = fft_mags[:nframes]
+        imag2 = fft_mags_imag[:nframes]
+        np.multiply(spec.real, spec.real, out=mags2)
+        np.multiply(spec.imag, spec.imag, out=imag2)
+        mags2 += imag2
+
+        with accum_lock:
+            a_weight_sum += a_weighted_sum
+            a_weight_n += len(a_weighted)
+            bin_accumulator += mags2.sum(axis=0, dtype=np.float32)
+            n_samples += nframes
     else:
-        logging.warning("No data received in callback")
+        logging.warning("No data received in block")
+        fft_carry = 0  # Don't run frames across the gap
 
         # Don't report empty data if we got a status message
-        if not got_status:
+        if not status:
             errtags = TAGS.copy()
             errtags["error"] = "got_status"
 
-            frame_queue.append({
+            enqueue({
                 "measurement": args.measurement_name + "_error",
                 "fields": { "status_text": "Empty data" },
-                "time": ts,
+                "time": time.time_ns(),
             })
 
 
-try:
-    with sd.InputStream(device=args.device, channels=1, callback=callback,
-                        blocksize=args.blocksize, samplerate=samplerate):
+def fft_worker():
+    '''FFT worker thread: process blocks as the callback fills the ring'''
+    global ring_tail, fft_carry
 
-        n_zero_loops = 0
-        max_zero_loops = 3
-
-        while True:
-            time.sleep(args.time)
+    while True:
+        ring_event.wait()
+        ring_event.clear()
 
-            splits = [ 100, 500, 1000, 2500, 5000, 10000, ]
-            mag_sums = np.zeros_like(splits)
-            mag_cnts = np.zeros_like(mag_sums)
+        while ring_tail < ring_head:
+            slot = ring_tail % RING_SLOTS
+            if ring_gap[slot]:
+                fft_carry = 0  # Don't run frames across dropped blocks
+            try:
+                process_block(ring[slot, :ring_len[slot]], ring_status[slot])
+            except Exception as e:
+                logging.error(f'Failed to process block: {e}')
+            ring_tail += 1
 
-            # Send the backlog of error messages if we have one
-            if frame_queue:
-                logging.debug(f'Submitting {len(frame_queue)} errors')
-                client.write_points(frame_queue)
-                frame_queue.clear()
 
-            # Record the overall RMS, and number of samples
-            results = {
-                "rms": np.sqrt(np.sum(bin_accumulator)/len(bin_accumulator)/n_samples),
-                "n_samples": n_samples,
-            }
+threading.Thread(target=sender_loop, daemon=True).start()
+threading.Thread(target=fft_worker, daemon=True).start()
 
-            # Compute the aggregated frequency range values
-            hz_per_bin = samplerate/fftsize
-            f_nyquist = samplerate//2  # integer for formatting
-            last_bin1 = 1  # skip DC
-            for i, f_cut in enumerate(splits):
-                if f_cut > f_nyquist:
-                    break
+try:
+    with sd.RawInputStream(device=args.device, channels=1, callback=callback,
+                           blocksize=args.blocksize, samplerate=samplerate,
+                           dtype='int16'):
 
-                bin0 = last_bin1
-                bin1 = int(min(f_cut//hz_per_bin, fftsize))
+        n_zero_loops = 0
+        max_zero_loops = 3
 
-                mag_sums[i] += np.sum(bin_accumulator[bin0:bin1])
-                mag_cnts[i] = bin1 - bin0
+        # Moving average of the mean power in each bin, across readings
+        bin_power = np.zeros(N_BINS, dtype=np.float32)
+        have_power = False
 
-                last_bin1 = bin1
+        while True:
+            time.sleep(args.time)
 
-            if not n_samples:
+            if send_failed.is_set():
+                parser.exit('Too many failed writes to influxdb, exiting to restart')
+
+            ts = time.time_ns()  # One timestamp for this whole cycle
+
+            with accum_lock:
+                # Record the number of samples
+                results = {
+                    "n_samples": n_samples,
+                    "n_dropped": n_dropped,
+                    "n_overruns": n_overruns,
+                    "n_send_failures": n_send_failures,
+                }
+
+                if n_samples:
+                    results["rms_a"] = np.sqrt(a_weight_sum/a_weight_n)
+
+                    # Fold this reading's mean bin powers into the moving
+                    # average, starting it off with the first reading
+                    alpha = args.ema_alpha if have_power else 1.0
+                    bin_accumulator *= alpha/n_samples
+                    bin_power *= 1 - alpha
+                    bin_power += bin_accumulator
+                    have_power = True
+
+                    # Record the overall RMS and our per-range results
+                    results["rms"] = np.sqrt(np.sum(bin_power, dtype=np.float64)/len(bin_power))
+                    mag_rms = aggregate(bin_power, BAND_EDGES)
+                    results.update(zip(BAND_LABELS, mag_rms))
+
+                n_samples = 0
+                a_weight_sum = 0.0
+                a_weight_n = 0
+                bin_accumulator.fill(0.0)
+
+            if not results["n_samples"]:
                 n_zero_loops += 1
                 if n_zero_loops >= max_zero_loops:
                     logging.error(f'Got {n_zero_loops} loops without any samples recorded, bailing')
-                    res_body = [{
+                    enqueue({
                         "measurement": args.measurement_name + "_error",
                         "fields": { "status_text": "Too many zero samples",
                                     "n_zero_loops": n_zero_loops, },
-                        "time":  datetime.datetime.utcnow().isoformat()
-                    }]
-                    client.write_points(res_body)
+                        "time": ts,
+                    })
+                    send_q.join()  # Flush everything out before we go
 
                     parser.exit(f'Exceeded max zero sample loops, exiting to restart sound device')
-            else:
-                # Generate our per-range results
-                last_fcut = 0
-                for i, f_cut in enumerate(splits):
-                    if f_cut > f_nyquist:
-                        break
-
-                    lbl = f"f{last_fcut}-{f_cut}"
-                    results[lbl] = np.sqrt(mag_sums[i]/mag_cnts[i]/n_samples)
-                    last_fcut = f_cut
-
-            n_samples = 0
-            bin_accumulator = np.zeros_like(bin_accumulator)
 
             # And bundle it all up to send
-            ts = datetime.datetime.utcnow().isoformat()
             d = {
                 "measurement": args.measurement_name,
                 "tags": TAGS,
@@ -232,9 +493,7 @@ try:
 
             logging.debug(d)
 
-            json_body = [d]
-            client.write_points(json_body)
-            logging.debug(f'Sent datapoints: {json_body}')
+            enqueue(d)
 
 except KeyboardInterrupt:
     logging.error('Got keybord interrupt')